@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Event loop stall benchmark.
+
+One stream receives a large stanza (a 5 MB vCard by default) in 256 KiB reads
+(STARTTLSTransport's maximum) while a second stream on the same loop does IQ ping round trips. The ping
+round trip times show how long parsing the large stanza stalls the loop,
+compare with and without --offload-bytes.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from functools import partial
+
+from vexmpp.client import Credentials
+from vexmpp.stream import Stream, Mixin
+from vexmpp.stanzas import Iq
+from vexmpp.parser import Parser, LxmlParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from parser_bench import STREAM_HEADER, _vcardStanza  # noqa: E402
+
+PARSERS = {"expat": Parser, "lxml": LxmlParser,
+           "lazy": partial(Parser, lazy=True)}
+
+
+class LoopbackTransport:
+    """Answers each IQ written to ``stream`` with a result, on the next loop
+    iteration, as if from a very fast server."""
+    def __init__(self, stream):
+        self._stream = stream
+        self._closing = False
+
+    def write(self, data):
+        if data.startswith(b"<iq"):
+            iq_id = data.split(b'id="')[1].split(b'"')[0]
+            asyncio.get_event_loop().call_soon(
+                    self._stream.data_received,
+                    b"<iq type='result' id='%s'/>" % iq_id)
+
+    def close(self):
+        self._closing = True
+
+
+class VCardMixin(Mixin):
+    def __init__(self):
+        self.received = asyncio.Event()
+        super().__init__([])
+
+    async def onStanza(self, stream, stanza):
+        if stanza.id == "v1":
+            self.received.set()
+
+
+def _makeStream(args, offload_bytes=None, mixins=None):
+    stream = Stream(Credentials("bench@example.com/stall", "x"),
+                    mixins=mixins, parser_factory=PARSERS[args.parser],
+                    parser_offload_bytes=offload_bytes)
+    stream.connection_made(LoopbackTransport(stream))
+    stream.data_received(STREAM_HEADER)
+    return stream
+
+
+async def _feed(stream, stanza, read_size):
+    for i in range(0, len(stanza), read_size):
+        stream.data_received(stanza[i:i + read_size])
+        await asyncio.sleep(0)
+
+
+async def _pings(stream, done):
+    rtts = []
+    while not done.is_set():
+        start = time.perf_counter()
+        await stream.sendAndWait(Iq(type="get", request=("ping",
+                                                         "urn:xmpp:ping")),
+                                 timeout=60)
+        rtts.append(time.perf_counter() - start)
+    return rtts
+
+
+async def run(args):
+    vcard_mixin = VCardMixin()
+    big_stream = _makeStream(args, offload_bytes=args.offload_bytes,
+                             mixins=[vcard_mixin])
+    ping_stream = _makeStream(args)
+    stanza = _vcardStanza(args.size_mb * 1024 * 1024)
+
+    pinger = asyncio.ensure_future(_pings(ping_stream, vcard_mixin.received))
+    await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    await _feed(big_stream, stanza, args.read_size)
+    await vcard_mixin.received.wait()
+    elapsed = time.perf_counter() - start
+    rtts = await pinger
+
+    rtts.sort()
+    print("{:d} byte stanza received in {:.3f} seconds".format(len(stanza),
+                                                               elapsed))
+    print("{:d} pings: median {:.2f} ms, max {:.2f} ms".format(
+          len(rtts), rtts[len(rtts) // 2] * 1000, rtts[-1] * 1000))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                            formatter_class=argparse.RawTextHelpFormatter)
+    arg_parser.add_argument("--parser", choices=PARSERS.keys(),
+                            default="expat")
+    arg_parser.add_argument("--size-mb", type=int, default=5)
+    arg_parser.add_argument("--read-size", type=int, default=256 * 1024)
+    arg_parser.add_argument("--offload-bytes", type=int, default=None)
+    args = arg_parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args))
+    # Stream parser tasks never complete, skip the loop shutdown.
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
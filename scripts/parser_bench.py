@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Parser benchmarks.
+
+  fragmented: large stanzas (e.g. a vCard photo) delivered in small reads,
+              the per-byte cost should stay flat as the stanza grows.
+  login:      repeatedly parses the LOGIN_XML corpus from tests/test_parser.py
+              (run from the source root).
+  forward:    parses the LOGIN_XML stanzas, rewrites their "to" address and
+              serializes them, as a relay forwarding them would.
+"""
+import sys
+import base64
+import argparse
+from functools import partial
+
+from vexmpp.utils import benchmark
+from vexmpp.parser import Parser, LxmlParser
+from vexmpp.stanzas import makeStanza
+
+STREAM_HEADER = (b"<stream:stream xmlns='jabber:client' "
+                 b"xmlns:stream='http://etherx.jabber.org/streams' "
+                 b"from='example.com' id='bench' version='1.0'>")
+PARSERS = {"expat": Parser, "lxml": LxmlParser,
+           # Stanza trees are never built, i.e. no handler touched them.
+           "lazy": partial(Parser, lazy=True)}
+
+
+def _vcardStanza(size):
+    # Base64 text wrapped at 76 columns, as most clients send photos.
+    b64 = base64.encodebytes(b"\xa5" * (size * 3 // 4))
+    return (b"<iq type='result' id='v1'><vCard xmlns='vcard-temp'><PHOTO>"
+            b"<TYPE>image/png</TYPE><BINVAL>" + b64 +
+            b"</BINVAL></PHOTO></vCard></iq>")
+
+
+def fragmented(args):
+    print("{:>10} {:>10} {:>12}".format("bytes", "seconds", "ns/byte"))
+    for mb in (0.125, 0.25, 0.5, 1, 2, 4):
+        stanza = _vcardStanza(int(mb * 1024 * 1024))
+        parser = PARSERS[args.parser]()
+        parser.parse(STREAM_HEADER)
+
+        count = 0
+        with benchmark() as timer:
+            for i in range(0, len(stanza), args.fragment_size):
+                count += len(parser.parse(stanza[i:i + args.fragment_size]))
+        assert(count == 1)
+
+        print("{:>10d} {:>10.4f} {:>12.2f}"
+              .format(len(stanza), timer["total"],
+                      timer["total"] * 1e9 / len(stanza)))
+
+
+def login(args):
+    from tests.test_parser import LOGIN_XML
+
+    count = 0
+    with benchmark() as timer:
+        for _ in range(args.iterations):
+            parser = PARSERS[args.parser]()
+            count += len(parser.parse(LOGIN_XML))
+
+    print("{:d} stanzas in {:.4f} seconds, {:.2f} us/stanza"
+          .format(count, timer["total"], timer["total"] * 1e6 / count))
+
+
+def forward(args):
+    from tests.test_parser import LOGIN_XML
+
+    count = 0
+    with benchmark() as timer:
+        for _ in range(args.iterations):
+            parser = PARSERS[args.parser]()
+            for elem in parser.parse(LOGIN_XML):
+                stanza = makeStanza(elem)
+                if stanza.name in ("iq", "message", "presence"):
+                    stanza.to = "relay@example.com/forwarded"
+                    stanza.toXml()
+                    count += 1
+
+    print("{:d} stanzas in {:.4f} seconds, {:.2f} us/stanza"
+          .format(count, timer["total"], timer["total"] * 1e6 / count))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                            formatter_class=argparse.RawTextHelpFormatter)
+    arg_parser.add_argument("--parser", choices=PARSERS.keys(),
+                            default="expat")
+    subs = arg_parser.add_subparsers(dest="bench")
+    frag_parser = subs.add_parser("fragmented")
+    frag_parser.add_argument("--fragment-size", type=int, default=1024)
+    frag_parser.set_defaults(func=fragmented)
+    login_parser = subs.add_parser("login")
+    login_parser.add_argument("--iterations", type=int, default=500)
+    login_parser.set_defaults(func=login)
+    forward_parser = subs.add_parser("forward")
+    forward_parser.add_argument("--iterations", type=int, default=500)
+    forward_parser.set_defaults(func=forward)
+
+    args = arg_parser.parse_args()
+    if "func" not in args:
+        arg_parser.print_help()
+        return 1
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
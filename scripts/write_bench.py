@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Outbound write benchmark.
+
+Sends small messages to a local server, plain or TLS, reporting the socket
+sends made by the client and the TLS records the server received. By default
+each message is sent from its own event loop iteration (--per-iteration 1),
+as when many hooks or tasks each send a stanza. Compare --cork off, auto
+(Stream(cork=True)) and batch (all sends in one Stream.batch() block).
+
+  --transport starttls  vexmpp.ssl_transport.STARTTLSTransport (pyOpenSSL)
+  --transport asyncio   asyncio's socket transport, and ssl module for TLS
+"""
+import os
+import ssl
+import sys
+import asyncio
+import datetime
+import argparse
+import tempfile
+from contextlib import ExitStack
+
+import OpenSSL.SSL
+
+from vexmpp.client import Credentials
+from vexmpp.stream import Stream
+from vexmpp.stanzas import Message
+from vexmpp.utils import benchmark
+from vexmpp.ssl_transport import create_starttls_connection
+
+TLS_APPLICATION_DATA = 23
+
+
+def selfSignedCert(directory, hostname="localhost"):
+    """Writes a self-signed certificate and key for ``hostname`` to
+    ``directory``, returning the (certfile, keyfile) paths."""
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName(
+                               [x509.DNSName(hostname)]), critical=False)
+            .sign(key, hashes.SHA256()))
+
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    with open(certfile, "wb") as fp:
+        fp.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as fp:
+        fp.write(key.private_bytes(serialization.Encoding.PEM,
+                                   serialization.PrivateFormat.PKCS8,
+                                   serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+class SinkProtocol(asyncio.Protocol):
+    """Counts the bytes received, and for TLS the records, decrypting with a
+    memory BIO so the record headers are visible."""
+    def __init__(self, ssl_context, expected):
+        self.expected = expected
+        self.done = asyncio.Future()
+        self.received = 0
+        self.records = 0
+        self._header = b""
+        self._skip = 0
+        self._tls = None
+        if ssl_context:
+            self._in, self._out = ssl.MemoryBIO(), ssl.MemoryBIO()
+            self._tls = ssl_context.wrap_bio(self._in, self._out,
+                                             server_side=True)
+            self._handshaking = True
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        if self._tls is None:
+            self._received(len(data))
+            return
+
+        if not self._handshaking:
+            self._countRecords(data)
+        self._in.write(data)
+        if self._handshaking:
+            try:
+                self._tls.do_handshake()
+                self._handshaking = False
+            except ssl.SSLWantReadError:
+                pass
+        self._transport.write(self._out.read())
+        try:
+            while True:
+                self._received(len(self._tls.read(64 * 1024)))
+        except ssl.SSLWantReadError:
+            pass
+
+    def _countRecords(self, data):
+        view = memoryview(data)
+        while view:
+            if self._skip:
+                n = min(self._skip, len(view))
+                self._skip -= n
+                view = view[n:]
+                continue
+            n = 5 - len(self._header)
+            self._header += bytes(view[:n])
+            view = view[n:]
+            if len(self._header) == 5:
+                if self._header[0] == TLS_APPLICATION_DATA:
+                    self.records += 1
+                self._skip = int.from_bytes(self._header[3:5], "big")
+                self._header = b""
+
+    def _received(self, n):
+        self.received += n
+        if self.received >= self.expected and not self.done.done():
+            self.done.set_result(None)
+
+
+class CountingSocket:
+    def __init__(self, sock):
+        self._sock = sock
+        self.sends = 0
+
+    def send(self, data, *args):
+        self.sends += 1
+        return self._sock.send(data, *args)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+async def _connect(args, stream, port):
+    loop = asyncio.get_event_loop()
+    if args.transport == "starttls":
+        ctx = None
+        if args.tls:
+            ctx = OpenSSL.SSL.Context(OpenSSL.SSL.TLS_METHOD)
+        transport, _ = await create_starttls_connection(
+                loop, lambda: stream, "127.0.0.1", port, ssl_context=ctx,
+                use_starttls=not args.tls, server_hostname="localhost")
+        # Counts SSL_write calls in TLS mode, each is at least one record.
+        transport._sock = CountingSocket(transport._sock)
+        return transport._sock
+
+    ctx = None
+    if args.tls:
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    transport, _ = await loop.create_connection(
+            lambda: stream, "127.0.0.1", port, ssl=ctx,
+            server_hostname="localhost" if ctx else None)
+    if ctx:
+        transport = transport._ssl_protocol._transport
+    transport._sock = CountingSocket(transport._sock)
+    return transport._sock
+
+
+async def _send(args, stream):
+    msg = Message(to="bench@example.com/sink", body="x" * args.body_size)
+    for i in range(args.count):
+        msg.id = str(i)
+        stream.send(msg)
+        if (i + 1) % args.per_iteration == 0:
+            await asyncio.sleep(0)
+
+
+async def run(args, server_ctx):
+    loop = asyncio.get_event_loop()
+    msg = Message(to="bench@example.com/sink", body="x" * args.body_size)
+    msg.id = "0"
+    expected = sum(len(msg.toXml()) - 1 + len(str(i))
+                   for i in range(args.count))
+
+    sink = SinkProtocol(server_ctx, expected)
+    server = await loop.create_server(lambda: sink, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    stream = Stream(Credentials("bench@example.com/writer", "x"),
+                    cork=(args.cork == "auto"))
+    counter = await _connect(args, stream, port)
+    await asyncio.sleep(0.1)
+    handshake_records = sink.records
+
+    with benchmark() as timer:
+        if args.cork == "batch":
+            async with stream.batch():
+                await _send(args, stream)
+        else:
+            await _send(args, stream)
+        await sink.done
+
+    print("{:d} messages, {:d} bytes in {:.4f} seconds: {:d} socket sends"
+          "{}".format(args.count, sink.received, timer["total"], counter.sends,
+                      ", {:d} TLS records".format(sink.records -
+                                                  handshake_records)
+                      if args.tls else ""))
+    server.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                            formatter_class=argparse.RawTextHelpFormatter)
+    arg_parser.add_argument("--transport", choices=("starttls", "asyncio"),
+                            default="starttls")
+    arg_parser.add_argument("--tls", action="store_true")
+    arg_parser.add_argument("--cork", choices=("off", "auto", "batch"),
+                            default="off")
+    arg_parser.add_argument("--count", type=int, default=10000)
+    arg_parser.add_argument("--body-size", type=int, default=32)
+    arg_parser.add_argument("--per-iteration", type=int, default=1,
+                            help="Messages sent per event loop iteration")
+    args = arg_parser.parse_args()
+
+    with ExitStack() as stack:
+        server_ctx = None
+        if args.tls:
+            tmp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            server_ctx.load_cert_chain(*selfSignedCert(tmp_dir))
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(run(args, server_ctx))
+
+    # The stream's parser task never completes, skip interpreter cleanup.
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
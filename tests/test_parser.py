@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 from io import BytesIO
+from functools import partial
+import pytest
 from vexmpp.parser import *
 
 
@@ -16,6 +18,100 @@ def testParse():
     #print("COUNT: %d" % count)
 
 
+def testLxmlParse():
+    expat_elems = Parser().parse(LOGIN_XML)
+
+    p = LxmlParser()
+    lxml_elems = []
+    # Fragmented reads
+    for i in range(0, len(LOGIN_XML), 100):
+        lxml_elems += p.parse(LOGIN_XML[i:i + 100])
+
+    assert(len(lxml_elems) == len(expat_elems) == 49)
+    for expat_elem, lxml_elem in zip(expat_elems, lxml_elems):
+        assert([(e.tag, dict(e.attrib)) for e in expat_elem.iter()] ==
+               [(e.tag, dict(e.attrib)) for e in lxml_elem.iter()])
+        assert(expat_elem.nsmap == lxml_elem.nsmap)
+
+
+def testFragmentedText():
+    stanza = (b"<message><body>" + b"x" * 5000 + b"<b>y</b>" + b"z" * 10 +
+              b"</body></message>")
+    p = Parser()
+    p.parse(STREAM_HEADER)
+
+    elems = []
+    for i in range(0, len(stanza), 7):
+        elems += p.parse(stanza[i:i + 7])
+
+    assert(len(elems) == 1)
+    body = elems[0][0]
+    assert(body.text == "x" * 5000 + "z" * 10)
+    assert(body[0].text == "y")
+
+
+def testLazyParse():
+    from vexmpp.stanzas import RawStanza, StanzaHeader, makeStanza
+
+    expat_elems = Parser().parse(LOGIN_XML)
+    lazy_elems = _parseAll(Parser(lazy=True), LOGIN_XML, 7)
+    assert(len(lazy_elems) == len(expat_elems) == 49)
+
+    raw_count = 0
+    for expat_elem, lazy_elem in zip(expat_elems, lazy_elems):
+        if isinstance(lazy_elem, RawStanza):
+            raw_count += 1
+            header = lazy_elem.header
+            assert(lazy_elem.raw.startswith(b"<" + header.tag.encode()))
+
+            stanza = makeStanza(lazy_elem)
+            assert(not stanza.built)
+            lazy_elem = stanza.xml
+            assert(stanza.built)
+
+            # The parsed header matches one taken from the built tree
+            assert(header == StanzaHeader.fromXml(lazy_elem))
+        assert([(e.tag, dict(e.attrib)) for e in expat_elem.iter()] ==
+               [(e.tag, dict(e.attrib)) for e in lazy_elem.iter()])
+    assert(raw_count == 41)
+
+
+def _parseAll(parser, data, chunk_size=None):
+    chunk_size = chunk_size or len(data)
+    elems = []
+    for i in range(0, len(data), chunk_size):
+        elems += parser.parse(data[i:i + chunk_size])
+    return elems
+
+
+@pytest.mark.parametrize("Parser_", [Parser, partial(Parser, lazy=True),
+                                     LxmlParser])
+def testStanzaLimits(Parser_):
+    from vexmpp.errors import PolicyViolationStreamError
+
+    deep = b"<iq>" + b"<a>" * 9 + b"</a>" * 9 + b"</iq>"
+    wide = b"<iq><q>" + b"<a/>" * 10 + b"</q></iq>"
+    big = b"<message><body>" + b"x" * 4096 + b"</body></message>"
+
+    # Within limits
+    p = Parser_(max_stanza_bytes=8192, max_depth=10, max_children=10)
+    assert(len(_parseAll(p, STREAM_HEADER + deep + wide + big, 100)) == 4)
+
+    for data, limits in [(deep, {"max_depth": 9}),
+                         (wide, {"max_children": 9}),
+                         (big, {"max_stanza_bytes": 2048}),
+                         ]:
+        p = Parser_(**limits)
+        p.parse(STREAM_HEADER)
+        with pytest.raises(StanzaLimitError) as ex_info:
+            _parseAll(p, data, 512)
+        assert(isinstance(ex_info.value.stream_error,
+                          PolicyViolationStreamError))
+
+
+STREAM_HEADER = (b"<stream:stream xmlns='jabber:client' "
+                 b"xmlns:stream='http://etherx.jabber.org/streams'>")
+
 LOGIN_XML = b'''<?xml version="1.0"?>
 <!-- Out -->
 <stream:stream xmlns="jabber:client" to="jabber.nicfit.net" version="1.0" xmlns:stream="http://etherx.jabber.org/streams" >
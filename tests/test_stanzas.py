@@ -27,3 +27,52 @@ def testPresenceOrdering():
                 Presence(priority=10, show=Presence.SHOW_CHAT))
     assert not (Presence(priority=10, show=Presence.SHOW_CHAT) >
                 Presence(priority=10, show=Presence.SHOW_CHAT))
+
+
+def testStanzaHeader():
+    from vexmpp.utils import xpathFilter
+
+    xml = etree.fromstring(b"<iq type='get' id='v1' from='a@b/c'>"
+                           b"<query xmlns='jabber:iq:version'/></iq>")
+    iq = makeStanza(xml)
+    assert(iq.header == StanzaHeader("iq", "get", "v1", "a@b/c", None,
+                                     "jabber:iq:version"))
+    assert(Iq().header is None)
+
+    @xpathFilter(("/iq[@type='get']/v:query", {"v": "jabber:iq:version"}))
+    async def onVersion(stanza):
+        pass
+
+    @xpathFilter(["/message", "/iq[@type='set']"])
+    async def onOther(stanza):
+        pass
+
+    assert(onVersion.interests == [("iq", "get", "jabber:iq:version")])
+    assert(onOther.interests == [("message", None, None), ("iq", "set", None)])
+
+    # Setting routing attributes updates the header
+    iq.type = "result"
+    iq.swapToFrom()
+    assert(iq.header[:5] == ("iq", "result", "v1", "a@b/c", "a@b/c"))
+    assert(iq.xml.get("type") == "result")
+
+
+def testRawPassthrough():
+    from vexmpp.parser import Parser
+
+    parser = Parser(lazy=True)
+    parser.parse(b"<stream:stream xmlns='jabber:client' "
+                 b"xmlns:stream='http://etherx.jabber.org/streams'>")
+    raw = (b"<message id=\"to='x'\" to='a@b'>"
+           b"<body>hi &amp; bye</body></message>")
+    msg = makeStanza(parser.parse(raw)[0])
+    assert(msg.toXml() == raw)
+
+    # Addressing is rewritten in the wire bytes, without building the tree
+    msg.to = "c@d/e"
+    msg.frm = "a@b"
+    assert(not msg.built)
+    assert(msg.header.to == "c@d/e")
+    assert(msg.toXml() == b"<message from=\"a@b\" id=\"to='x'\" to=\"c@d/e\">"
+                          b"<body>hi &amp; bye</body></message>")
+    assert(msg.xml.get("to") == "c@d/e")
@@ -0,0 +1,70 @@
+from vexmpp.stanzas import Iq, Message
+from vexmpp.stream import ReplayBuffer
+
+
+def testReplayBuffer():
+    replay = ReplayBuffer(max_count=3, max_bytes=None, max_age=None)
+    for i in range(5):
+        replay.append(Iq(id=str(i)))
+    replay.append(Message())
+    assert([e.stanza.id for e in replay.entries()] == ["3", "4", None])
+    assert([e.stanza.id for e in replay.entries(ids={"1", "4"})] == ["4"])
+
+    # Tasks are replayed each entry once
+    class Task:
+        pass
+    task = Task()
+    first, second, third = replay.entries()
+    assert(replay.markSeen(task, second))
+    assert(not replay.markSeen(task, first))
+    assert(replay.markSeen(task, third))
+    assert(not replay.markSeen(task))
+
+    replay = ReplayBuffer(max_count=None, max_bytes=100, max_age=None)
+    for i in range(10):
+        replay.append(Iq(id=str(i)))
+    assert(0 < len(replay) < 10)
+    assert(replay.entries()[-1].stanza.id == "9")
+
+    replay = ReplayBuffer(max_age=30)
+    replay.append(Iq(id="old")).time -= 60
+    replay.append(Iq(id="new"))
+    assert([e.stanza.id for e in replay.entries()] == ["new"])
+
+
+def testBatch():
+    import asyncio
+    from vexmpp.stream import Stream
+
+    class Transport:
+        _closing = False
+
+        def __init__(self):
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append(data)
+
+    async def _batch():
+        stream = Stream(None)
+        stream.connection_made(Transport())
+        async with stream.batch():
+            async with stream.batch():
+                stream.send(b"<a/>")
+            stream.send(b"<b/>")
+            assert(stream._transport.writes == [])
+        assert(stream._transport.writes == [b"<a/><b/>"])
+
+        # Corked output is written at the end of the loop iteration
+        stream._cork = True
+        stream.send(b"<c/>")
+        stream.send(b"<d/>")
+        await asyncio.sleep(0)
+        assert(stream._transport.writes[1:] == [b"<c/><d/>"])
+        stream._parser_task.cancel()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_batch())
+    finally:
+        loop.close()
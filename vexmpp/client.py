@@ -47,11 +47,20 @@ class Credentials:
 
 class ClientStream(Stream):
     def __init__(self, creds, tls_opt=None, state_callbacks=None,
-                 mixins=None, default_timeout=None, register_cb=None):
+                 mixins=None, default_timeout=None, register_cb=None,
+                 parser_factory=None, batch_parsing=False,
+                 inline_parsing=False, parser_offload_bytes=None,
+                 dispatch_budget=0.01, replay_buffer=None, cork=False):
         self._tls_opt = tls_opt or TlsOpts.on
         self._register_cb = register_cb
         super().__init__(creds, state_callbacks=state_callbacks, mixins=mixins,
-                         default_timeout=default_timeout)
+                         default_timeout=default_timeout,
+                         parser_factory=parser_factory,
+                         batch_parsing=batch_parsing,
+                         inline_parsing=inline_parsing,
+                         parser_offload_bytes=parser_offload_bytes,
+                         dispatch_budget=dispatch_budget,
+                         replay_buffer=replay_buffer, cork=cork)
 
     async def _reopenStream(self, timeout=None):
         # Reopen stream
@@ -2,6 +2,7 @@
 from lxml.etree import Element
 from .namespaces import STREAM_NS_URI, STREAM_ERROR_NS_URI, STANZA_ERROR_NS_URI
 from .stanzas import XML_LANG
+from .utils import compiledXPath
 
 '''
 Concrete :class:StanzaError types.
@@ -277,7 +278,7 @@ def makeStanzaError(xml):
 
 def _makeConcreteError(xml):
     stream_error, stanza_error = False, False
-    if xml.xpath("/stream:error", namespaces={"stream": STREAM_NS_URI}):
+    if compiledXPath("/stream:error", {"stream": STREAM_NS_URI})(xml):
         stream_error = True
         error_ns = STREAM_ERROR_NS_URI
     elif xml.tag == "error":
@@ -1,22 +1,122 @@
 # -*- coding: utf-8 -*-
+from copy import deepcopy
 from xml.parsers import expat
 from lxml import etree
 from collections import deque
 
 from . import getLogger
+from .errors import PolicyViolationStreamError
+from .stanzas import StanzaHeader, RawStanza, unqualifyStanza
 from .namespaces import STREAM_NS_URI, CLIENT_NS_URI, SERVER_NS_URI
 
 
 class ParseError(RuntimeError):
+    # The vexmpp.errors.StreamError to send to the peer, if any.
+    stream_error = None
+
     def __init__(self, msg, state):
         super(ParseError, self).__init__(msg)
         self.parser_state = state
 
 
+class StanzaLimitError(ParseError):
+    '''Raised when a stanza exceeds a parser limit (size, depth or number of
+    children). The stream should be closed with a policy-violation error.'''
+    def __init__(self, msg, state):
+        super().__init__(msg, state)
+        self.stream_error = PolicyViolationStreamError(text=msg)
+
+
+class StanzaLimits(object):
+    '''Per stanza limits, ``None`` values are unlimited.
+
+    ``max_stanza_bytes`` is the maximum number of (encoded) bytes of a stanza,
+    ``max_depth`` the maximum element nesting depth (the stanza element is at
+    depth 1), and ``max_children`` the maximum number of child elements any
+    single element may have.
+    '''
+    def __init__(self, max_stanza_bytes=None, max_depth=None,
+                 max_children=None):
+        self.max_stanza_bytes = max_stanza_bytes
+        self.max_depth = max_depth
+        self.max_children = max_children
+
+    def checkSize(self, nbytes, state):
+        if (self.max_stanza_bytes is not None and
+                nbytes > self.max_stanza_bytes):
+            raise StanzaLimitError("Stanza exceeds {:d} bytes"
+                                   .format(self.max_stanza_bytes), state)
+
+    def checkDepth(self, depth, state):
+        if self.max_depth is not None and depth > self.max_depth:
+            raise StanzaLimitError("Stanza exceeds depth of {:d}"
+                                   .format(self.max_depth), state)
+
+    def checkChildren(self, count, state):
+        if self.max_children is not None and count > self.max_children:
+            raise StanzaLimitError("Stanza element exceeds {:d} children"
+                                   .format(self.max_children), state)
+
+
+_STREAM_HEADER_NAME = "%s stream" % STREAM_NS_URI
+
+# Expat names ("ns<space>name") mapped to (tag, nsmap, is_stream_header, ns).
+# Bounded, once full new names are computed but not cached.
+_NAME_CACHE = {}
+_NAME_CACHE_MAX = 1024
+
+
+def _internName(name):
+    entry = _NAME_CACHE.get(name)
+    if entry is None:
+        entry = _makeNameEntry(name)
+        if len(_NAME_CACHE) < _NAME_CACHE_MAX:
+            _NAME_CACHE[name] = entry
+    return entry
+
+
+def _makeNameEntry(name):
+    ns, local_name = name.split()
+
+    if ns == STREAM_NS_URI:
+        # The stream header nsmap depends on its default namespace, it is
+        # completed by the parser.
+        return ("{%s}%s" % (ns, local_name), {"stream": STREAM_NS_URI},
+                local_name == "stream", ns)
+    elif ns in (CLIENT_NS_URI, SERVER_NS_URI):
+        return (local_name, None, False, ns)
+    else:
+        return ("{%s}%s" % (ns, local_name), {None: ns}, False, ns)
+
+
 class Parser(object):
-    def __init__(self):
+    """Expat based stream parser, ``parse`` returns the complete top level
+    elements (stanzas) as lxml elements.
+
+    When ``lazy`` is True, client/server stanzas (iq, message, presence) are
+    returned as :class:`vexmpp.stanzas.RawStanza` objects, holding their
+    routing header and wire bytes, and their element trees are only built when
+    accessed. Stream level elements (features, errors, SASL, etc.) are always
+    built.
+    """
+    def __init__(self, max_stanza_bytes=None, max_depth=None,
+                 max_children=None, lazy=False):
         self._expat = None
         self._curr = None
+        self._limits = StanzaLimits(max_stanza_bytes=max_stanza_bytes,
+                                    max_depth=max_depth,
+                                    max_children=max_children)
+        # Total bytes fed to expat, and the offset where the current stanza
+        # (or the data following the last one) begins.
+        self._bytes_fed = 0
+        self._stanza_offset = 0
+
+        self._lazy = lazy
+        # Lazy mode: the unparsed stream bytes beginning at ``_raw_offset``,
+        # and the namespaces declared by the stream header.
+        self._raw = bytearray()
+        self._raw_offset = 0
+        self._stream_nsmap = {}
 
         self._stanzas = deque()
 
@@ -30,6 +130,17 @@ class Parser(object):
                 self.nsmap = {}
                 self.level = 0
                 self.elem = None
+                # Character data chunks for ``elem``, and those of its
+                # ancestors. Joined once when the element ends.
+                self.text = []
+                self.text_stack = []
+                # Child counts of the open elements
+                self.children = []
+                # Lazy stanza state: header fields, first child namespace,
+                # and whether it has content.
+                self.lazy = None
+                self.child_ns = None
+                self.empty = True
         self._curr = ParseState()
 
         self.reset()
@@ -39,10 +150,19 @@ class Parser(object):
 
         self._expat = expat.ParserCreate("utf-8", " ")
         self._expat.StartNamespaceDeclHandler = self._onStartNamespace
-        self._expat.StartElementHandler = self._onStartElement
-        self._expat.EndElementHandler = self._onEndElement
-        self._expat.CharacterDataHandler = self._onCharData
-
+        if self._lazy:
+            self._expat.StartElementHandler = self._onLazyStartElement
+            self._expat.EndElementHandler = self._onLazyEndElement
+            self._expat.CharacterDataHandler = self._onLazyCharData
+        else:
+            self._expat.StartElementHandler = self._onStartElement
+            self._expat.EndElementHandler = self._onEndElement
+            self._expat.CharacterDataHandler = self._onCharData
+
+        self._bytes_fed = 0
+        self._stanza_offset = 0
+        self._raw = bytearray()
+        self._raw_offset = 0
         self._curr.reset()
 
     def _onStartNamespace(self, prefix, uri):
@@ -61,7 +181,12 @@ class Parser(object):
             # Peer sent </stream:stream>
             self._curr.reset()
 
-        self._curr.last_data += data
+        # Only the chunk being parsed is kept for error reporting, any
+        # previous data was consumed without error.
+        self._curr.last_data = data
+        self._bytes_fed += len(data)
+        if self._lazy:
+            self._raw += data
         try:
             self._expat.Parse(data)
         except expat.ExpatError as ex:
@@ -69,53 +194,48 @@ class Parser(object):
         else:
             self._curr.last_data = b""  # No ExpatError, clear state buffer
 
+        if self._lazy:
+            # Keep only the bytes of the stanza in progress
+            del self._raw[:self._stanza_offset - self._raw_offset]
+            self._raw_offset = self._stanza_offset
+
+        # Catches data expat is buffering without making callbacks, such as
+        # an unterminated start tag.
+        self._limits.checkSize(self._bytes_fed - self._stanza_offset,
+                               self._curr)
+
         parsed_stanzas = []
         if self._stanzas:
             parsed_stanzas += [s for s in self._stanzas]
             self._stanzas.clear()
         return parsed_stanzas
 
-    def _onStartStreamElement(self, name):
-        assert(self._curr.elem is None)
-
-        nsmap = {"stream": STREAM_NS_URI}
-        if name == "stream":
-            nsmap[None] = self._curr.nsmap[None]
-        tag = "{%s}%s" % (STREAM_NS_URI, name)
-
-        elem = etree.Element(tag, nsmap=nsmap)
-
-        return elem
-
-    def _onStartStanzaElement(self, name, ns):
-        assert(self._curr.elem is None)
-
-        nsmap = None if ns in [CLIENT_NS_URI, SERVER_NS_URI] else {None: ns}
-        tag = "{%s}%s" % (ns, name) if nsmap else name
-
-        elem = etree.Element(tag, nsmap=nsmap)
-
-        return elem
-
-    def _onStartChildElement(self, name, ns):
-        assert(self._curr.elem is not None)
-
-        nsmap = None if ns in [CLIENT_NS_URI, SERVER_NS_URI] else {None: ns}
-        tag = "{%s}%s" % (ns, name) if nsmap else name
+    @property
+    def pending_bytes(self):
+        '''The number of bytes parsed of the incomplete stanza, if any.'''
+        return self._bytes_fed - self._stanza_offset
 
-        elem = etree.Element(tag, nsmap=nsmap)
-        return elem
+    def _checkLimits(self):
+        curr = self._curr
+        if curr.level == 0:
+            self._stanza_offset = self._expat.CurrentByteIndex
+        else:
+            self._limits.checkChildren(curr.children[-1] + 1, curr)
+            self._limits.checkSize(
+                    self._expat.CurrentByteIndex - self._stanza_offset, curr)
+        self._limits.checkDepth(curr.level + 1, curr)
 
     def _onStartElement(self, name, attrs):
         # name is 'ns<space>name'
-        elem_ns, elem_name = name.split()
+        tag, nsmap, is_header, _ = _internName(name)
 
-        if elem_ns == STREAM_NS_URI:
-            elem = self._onStartStreamElement(elem_name)
-        elif self._curr.elem is None:
-            elem = self._onStartStanzaElement(elem_name, elem_ns)
-        else:
-            elem = self._onStartChildElement(elem_name, elem_ns)
+        self._checkLimits()
+
+        if is_header:
+            self._stream_nsmap = dict(self._curr.nsmap)
+            nsmap = dict(nsmap)
+            nsmap[None] = self._curr.nsmap[None]
+        elem = etree.Element(tag, nsmap=nsmap)
 
         for a in attrs:
             if " " in a:
@@ -126,34 +246,209 @@ class Parser(object):
             else:
                 elem.attrib[a] = attrs[a]
 
-        if self.isStreamHeader(elem):
+        if is_header:
             self._curr.elem = None
             self._stanzas.append(elem)
         else:
             self._curr.level += 1
             if self._curr.elem is not None:
                 self._curr.elem.append(elem)
+                self._curr.text_stack.append(self._curr.text)
+                self._curr.text = []
+                self._curr.children[-1] += 1
+            self._curr.children.append(0)
             self._curr.elem = elem
 
     def _onEndElement(self, name):
-        if tuple(name.split()) == (STREAM_NS_URI, "stream"):
+        if name == _STREAM_HEADER_NAME:
             self._curr.end_of_stream = True
             return
 
+        if self._curr.text:
+            self._curr.elem.text = "".join(self._curr.text)
+
         self._curr.level -= 1
         if self._curr.level == 0:
             self._stanzas.append(self._curr.elem)
             self._curr.reset()
+            self._stanza_offset = self._expat.CurrentByteIndex
         else:
             if self._curr.elem is not None:
                 self._curr.elem = self._curr.elem.getparent()
+                self._curr.text = self._curr.text_stack.pop()
+                self._curr.children.pop()
 
     def _onCharData(self, data):
-        if self._curr.elem is not None and len(data.strip()):
-            if self._curr.elem.text is None:
-                self._curr.elem.text = data
+        if self._curr.elem is None:
+            # Whitespace between stanzas (e.g. keepalives)
+            self._stanza_offset = self._expat.CurrentByteIndex
+        elif data.strip():
+            if self._limits.max_stanza_bytes is not None:
+                self._limits.checkSize(
+                        self._expat.CurrentByteIndex - self._stanza_offset,
+                        self._curr)
+            self._curr.text.append(data)
+
+    def _onLazyStartElement(self, name, attrs):
+        curr = self._curr
+        tag, nsmap, is_header, ns = _internName(name)
+
+        if curr.lazy is not None:
+            # Inside a lazy stanza, only limits are tracked
+            self._checkLimits()
+            if curr.level == 1 and not curr.children[-1] and \
+                    nsmap is not None:
+                # First child, when not in the client/server namespace
+                curr.child_ns = ns
+            curr.children[-1] += 1
+            curr.children.append(0)
+            curr.level += 1
+            curr.empty = False
+        elif curr.level == 0 and nsmap is None:
+            # A client/server stanza
+            self._checkLimits()
+            curr.lazy = (tag, attrs.get("type"), attrs.get("id"),
+                         attrs.get("from"), attrs.get("to"))
+            curr.child_ns = None
+            curr.empty = True
+            curr.children.append(0)
+            curr.level = 1
+        else:
+            self._onStartElement(name, attrs)
+
+    def _onLazyEndElement(self, name):
+        curr = self._curr
+        if curr.lazy is None:
+            return self._onEndElement(name)
+
+        curr.level -= 1
+        if curr.level:
+            curr.children.pop()
+            return
+
+        raw = self._raw
+        start = self._stanza_offset - self._raw_offset
+        end = self._expat.CurrentByteIndex - self._raw_offset
+        if not (curr.empty and raw[end - 2:end] == b"/>"):
+            # ``end`` is the start of the end tag, e.g. "</iq>"
+            end = raw.index(b">", end) + 1
+
+        header = StanzaHeader(*curr.lazy, curr.child_ns)
+        self._stanzas.append(RawStanza(header, bytes(raw[start:end]),
+                                       self._stream_nsmap))
+        curr.reset()
+        self._stanza_offset = self._raw_offset + end
+
+    def _onLazyCharData(self, data):
+        if self._curr.lazy is not None:
+            self._curr.empty = False
+            if self._limits.max_stanza_bytes is not None:
+                self._limits.checkSize(
+                        self._expat.CurrentByteIndex - self._stanza_offset,
+                        self._curr)
+        else:
+            self._onCharData(data)
+
+
+class LxmlParser(object):
+    """A ``Parser`` alternative built on lxml's incremental pull parser.
+
+    Element construction is done entirely by libxml2, Python only tracks the
+    stanza depth and detaches each complete stanza from the stream document.
+    The returned elements have the same shape as those produced by
+    :class:`Parser`, i.e. stanzas in the client/server namespace are
+    unqualified.
+
+    Stanza limits are the same as :class:`Parser`'s, but are checked after
+    each chunk is fed so the size limit is only accurate to the chunk size.
+    """
+    _STREAM_TAG = "{%s}stream" % STREAM_NS_URI
+
+    isStreamHeader = staticmethod(Parser.isStreamHeader)
+    isStreamError = staticmethod(Parser.isStreamError)
+
+    def __init__(self, max_stanza_bytes=None, max_depth=None,
+                 max_children=None):
+        self._pull = None
+        self._level = 0
+        self._children = []
+        self._stanza_bytes = 0
+        self._limits = StanzaLimits(max_stanza_bytes=max_stanza_bytes,
+                                    max_depth=max_depth,
+                                    max_children=max_children)
+        self.end_of_stream = False
+
+        self.reset()
+
+    def reset(self):
+        log.debug("Resetting lxml parser")
+
+        self._pull = etree.XMLPullParser(events=("start", "end"),
+                                         remove_blank_text=True,
+                                         remove_comments=True,
+                                         remove_pis=True,
+                                         resolve_entities=False,
+                                         no_network=True)
+        self._level = 0
+        self._children = []
+        self._stanza_bytes = 0
+        self.end_of_stream = False
+
+    def parse(self, data):
+        if self.end_of_stream:
+            # Peer sent </stream:stream>
+            self.reset()
+
+        try:
+            self._pull.feed(data)
+        except etree.XMLSyntaxError as ex:
+            raise ParseError(str(ex), self)
+
+        parsed_stanzas = []
+        for event, elem in self._pull.read_events():
+            if elem.tag == self._STREAM_TAG:
+                if event == "start":
+                    # Hand out a childless copy, the original is the document
+                    # root that all stanzas are parsed into.
+                    parsed_stanzas.append(etree.Element(elem.tag,
+                                                        attrib=elem.attrib,
+                                                        nsmap=elem.nsmap))
+                elif elem.getparent() is None:
+                    self.end_of_stream = True
+            elif event == "start":
+                if self._level:
+                    self._children[-1] += 1
+                    self._limits.checkChildren(self._children[-1], self)
+                else:
+                    self._stanza_bytes = 0
+                self._level += 1
+                self._children.append(0)
+                self._limits.checkDepth(self._level, self)
             else:
-                self._curr.elem.text += data
+                self._level -= 1
+                self._children.pop()
+                if self._level == 0:
+                    self._stanza_bytes = 0
+                    parsed_stanzas.append(self._detachStanza(elem))
+
+        if self._level:
+            # A stanza spanning chunks, counted in whole chunks.
+            self._stanza_bytes += len(data)
+            self._limits.checkSize(self._stanza_bytes, self)
+
+        return parsed_stanzas
+
+    @property
+    def pending_bytes(self):
+        '''The number of bytes parsed of the incomplete stanza, counted in
+        whole chunks.'''
+        return self._stanza_bytes
+
+    def _detachStanza(self, elem):
+        elem.getparent().remove(elem)
+        # A copy gives the stanza its own document, so absolute XPaths
+        # (e.g. "/iq") are relative to the stanza and not the stream.
+        return unqualifyStanza(deepcopy(elem))
 
 
 log = getLogger(__name__)
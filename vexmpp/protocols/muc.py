@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from .. import stream
-from ..utils import xpathFilter
+from ..utils import xpathFilter, compiledXPath
 from ..jid import Jid as BaseJid
 from ..stanzas import Presence, Iq, ElementWrapper
 
@@ -180,10 +180,8 @@ async def enterRoom(stream, room, service, nick, password=None,
              {"mu": NS_URI_USER})
 
     # Owner create operations
-    if (pres.xml.xpath(ROOM_OWNER_PRESENCE_XPATH[0],
-                       namespaces=ROOM_OWNER_PRESENCE_XPATH[1]) and
-        pres.xml.xpath(ROOM_CREATED_PRESENCE_XPATH[0],
-                       namespaces=ROOM_CREATED_PRESENCE_XPATH[1])):
+    if (compiledXPath(*ROOM_OWNER_PRESENCE_XPATH)(pres.xml) and
+            compiledXPath(*ROOM_CREATED_PRESENCE_XPATH)(pres.xml)):
 
         if config_new_room_callback is None:
             # New instant room, accept the default config
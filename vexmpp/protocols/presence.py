@@ -3,7 +3,7 @@ import asyncio
 from operator import itemgetter
 from ..stream import Mixin
 from ..stanzas import Presence
-from ..utils import xpathFilter
+from ..utils import xpathFilter, compiledXPath
 from .muc import NS_URI_USER as MUC_USER_NS
 
 PRES_SUB_XPATH = "/presence[@type='subscribe']"
@@ -25,16 +25,16 @@ class SubscriptionAckMixin(Mixin):
 
     @xpathFilter(S10N_XPATHS)
     async def onStanza(self, stream, stanza):
-        if stanza.xml.xpath(PRES_SUB_XPATH):
+        if compiledXPath(PRES_SUB_XPATH)(stanza.xml):
             stream.send(Presence(to=stanza.frm,
                                  type=Presence.TYPE_SUBSCRIBED))
-        elif stanza.xml.xpath(PRES_UNSUB_XPATH):
+        elif compiledXPath(PRES_UNSUB_XPATH)(stanza.xml):
             stream.send(Presence(to=stanza.frm,
                                  type=Presence.TYPE_UNSUBSCRIBED))
-        elif stanza.xml.xpath(PRES_SUBED_XPATH):
+        elif compiledXPath(PRES_SUBED_XPATH)(stanza.xml):
             stream.send(Presence(to=stanza.frm,
                                  type=Presence.TYPE_SUBSCRIBE))
-        elif stanza.xml.xpath(PRES_UNSUBED_XPATH):
+        elif compiledXPath(PRES_UNSUBED_XPATH)(stanza.xml):
             stream.send(Presence(to=stanza.frm,
                                  type=Presence.TYPE_UNSUBSCRIBE))
 
@@ -47,16 +47,16 @@ class DenySubscriptionAckMixin(Mixin):
 
     @xpathFilter(S10N_XPATHS)
     async def onStanza(self, stream, stanza):
-        if stanza.xml.xpath(PRES_SUB_XPATH):
+        if compiledXPath(PRES_SUB_XPATH)(stanza.xml):
             stream.send(Presence(to=stanza.frm,
                                  type=Presence.TYPE_UNSUBSCRIBED))
-        elif stanza.xml.xpath(PRES_UNSUB_XPATH):
+        elif compiledXPath(PRES_UNSUB_XPATH)(stanza.xml):
             stream.send(Presence(to=stanza.frm,
                                  type=Presence.TYPE_SUBSCRIBED))
-        elif stanza.xml.xpath(PRES_SUBED_XPATH):
+        elif compiledXPath(PRES_SUBED_XPATH)(stanza.xml):
             stream.send(Presence(to=stanza.frm,
                                  type=Presence.TYPE_UNSUBSCRIBE))
-        elif stanza.xml.xpath(PRES_UNSUBED_XPATH):
+        elif compiledXPath(PRES_UNSUBED_XPATH)(stanza.xml):
             stream.send(Presence(to=stanza.frm,
                                  type=Presence.TYPE_SUBSCRIBE))
 
@@ -127,7 +127,7 @@ class PresenceCacheMixin(Mixin, PresenceDict):
 
         if (presence.type not in [Presence.TYPE_AVAILABLE,
                                   Presence.TYPE_UNAVAILABLE] or
-                presence.xml.xpath("//ns:x", namespaces={"ns": MUC_USER_NS})):
+                compiledXPath("//ns:x", {"ns": MUC_USER_NS})(presence.xml)):
             return
 
         from_jid = presence.frm
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import re
 import uuid
 import functools
 from copy import deepcopy
+from collections import namedtuple
+from xml.sax.saxutils import quoteattr
 from lxml import etree
 from .namespaces import (XML_NS_URI, STREAM_NS_URI,
                          CLIENT_NS_URI, SERVER_NS_URI,
@@ -181,6 +184,10 @@ class ElementWrapper:
 class Stanza(ElementWrapper):
     XPATH = (None, None)
 
+    # Received stanzas have a StanzaHeader, it is updated when routing
+    # attributes are set with ``set`` (or the properties using it).
+    _header = None
+
     TYPE_GET = "get"
     TYPE_SET = "set"
     TYPE_ERROR = "error"
@@ -198,6 +205,36 @@ class Stanza(ElementWrapper):
         for name, value in (attrs or {}).items():
             self.set(name, value)
 
+    @property
+    def header(self):
+        '''The :class:`StanzaHeader` of a received stanza, None for stanzas
+        created locally.'''
+        return self._header
+
+    @property
+    def name(self):
+        if self._header is not None:
+            return self._header.tag
+        return self.xml.tag
+
+    def get(self, key, default=None, as_jid=False):
+        # Routing attributes are read from the header when possible, this
+        # avoids building the tree of lazily parsed stanzas.
+        if self._header is not None and key in StanzaHeader.ATTRS:
+            value = getattr(self._header, StanzaHeader.ATTRS[key]) or default
+            if value:
+                return value if not as_jid else Jid(value)
+            else:
+                return None
+        return super().get(key, default=default, as_jid=as_jid)
+
+    def set(self, attr, s):
+        if self._header is not None and attr in StanzaHeader.ATTRS:
+            value = (s.full if isinstance(s, Jid) else s) or None
+            self._header = self._header._replace(
+                                **{StanzaHeader.ATTRS[attr]: value})
+        super().set(attr, s)
+
     def _initAttributes(self, to=None, frm=None, type=None, id=None):
         if to:
             self.to = to
@@ -567,18 +604,186 @@ class Message(Stanza):
         self._setChildText("thread", s)
 
 
+class StanzaHeader(namedtuple("StanzaHeader",
+                              "tag, type, id, frm, to, child_ns")):
+    '''The routing fields of a received stanza, as they were on the wire.
+
+    ``tag`` is the stanza tag as it appears in ``Stanza.xml`` (unqualified for
+    client/server stanzas), ``frm`` and ``to`` are strings, and ``child_ns`` is
+    the namespace URI of the first child element, None when there are no
+    children or the first is in the client/server namespace (e.g. <body>).
+    '''
+    __slots__ = ()
+
+    # Stanza attribute names to header fields
+    ATTRS = {"type": "type", "id": "id", "from": "frm", "to": "to"}
+
+    @classmethod
+    def fromXml(Class, xml):
+        child_ns = None
+        for child in xml:
+            child_ns = etree.QName(child).namespace
+            break
+        return Class(xml.tag, xml.get("type"), xml.get("id"), xml.get("from"),
+                     xml.get("to"), child_ns)
+
+
+_RAW_PARSER = etree.XMLParser(remove_blank_text=True, remove_comments=True,
+                              remove_pis=True, resolve_entities=False,
+                              no_network=True)
+_DEFAULT_NS_TAGS = ["{%s}*" % CLIENT_NS_URI, "{%s}*" % SERVER_NS_URI]
+
+
+def unqualifyStanza(elem):
+    '''Removes the client/server namespace from ``elem`` and its children,
+    as vexmpp represents them unqualified, e.g. "iq" and not "{jabber:client}iq".
+    '''
+    for e in elem.iter(*_DEFAULT_NS_TAGS):
+        e.tag = etree.QName(e).localname
+    etree.cleanup_namespaces(elem)
+    return elem
+
+
+_START_TAG_RE = re.compile(rb"<[^\s/>]+")
+_ATTR_RE = re.compile(rb"""\s+([^\s=/>]+)\s*=\s*(?:"[^"]*"|'[^']*')""")
+_ATTR_NAME_RE = re.compile(r"^[A-Za-z_][\w.-]*$")
+
+
+class RawStanza:
+    '''A stanza as received, its ``header`` and wire bytes (``raw``), whose
+    element tree is not built until ``build`` is called.
+
+    ``nsmap`` holds the namespace declarations in scope for the stanza,
+    i.e. those of the stream header.
+    '''
+    def __init__(self, header, raw, nsmap):
+        self.header = header
+        self.raw = raw
+        self.nsmap = nsmap
+
+    @property
+    def tag(self):
+        return self.header.tag
+
+    @property
+    def standalone(self):
+        '''True when ``raw`` can be sent as is on another stream, i.e. the
+        stream header declared no prefixes the stanza could be using.'''
+        return all(prefix in (None, "stream") for prefix in self.nsmap)
+
+    def setAttr(self, name, value):
+        '''Sets (or removes, when ``value`` is None) an unqualified
+        attribute of the stanza element by rewriting its start tag in ``raw``.
+        Returns False if ``name`` can not be rewritten this way.'''
+        if not _ATTR_NAME_RE.match(name):
+            return False
+        name = name.encode("utf-8")
+
+        raw = self.raw
+        pos = _START_TAG_RE.match(raw).end()
+        insert_at, attr_end = pos, pos
+        attr = _ATTR_RE.match(raw, pos)
+        while attr:
+            if attr.group(1) == name:
+                insert_at, attr_end = attr.start(), attr.end()
+                break
+            attr = _ATTR_RE.match(raw, attr.end())
+
+        new_attr = b""
+        if value is not None:
+            new_attr = b" " + name + b"=" + quoteattr(value).encode("utf-8")
+        self.raw = raw[:insert_at] + new_attr + raw[attr_end:]
+
+        field = StanzaHeader.ATTRS.get(name.decode("utf-8"))
+        if field:
+            self.header = self.header._replace(**{field: value})
+        return True
+
+    def build(self):
+        decls = " ".join("xmlns{}={}".format(":" + prefix if prefix else "",
+                                             quoteattr(uri))
+                         for prefix, uri in self.nsmap.items())
+        wrapper = etree.fromstring(("<_ %s>" % decls).encode("utf-8") +
+                                   self.raw + b"</_>", _RAW_PARSER)
+        # A copy gives the stanza its own document, so absolute XPaths
+        # (e.g. "/iq") are relative to the stanza.
+        return unqualifyStanza(deepcopy(wrapper[0]))
+
+
+class _LazyStanza:
+    '''Stanza mixin for received stanzas whose ``xml`` is built from a
+    RawStanza on first access. Until then attributes set via ``set`` are
+    rewritten in the wire bytes, which ``toXml`` returns as is.'''
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            self._xml = self._raw.build()
+        return self._xml
+
+    @xml.setter
+    def xml(self, xml):
+        self._xml = xml
+
+    @property
+    def built(self):
+        return self._xml is not None
+
+    @property
+    def raw_size(self):
+        '''The size of the stanza's wire bytes.'''
+        return len(self._raw.raw)
+
+    def set(self, attr, s):
+        if self._xml is None:
+            value = (s.full if isinstance(s, Jid) else s) or None
+            if self._raw.setAttr(attr, value):
+                self._header = self._raw.header
+                return
+        super().set(attr, s)
+
+    def toXml(self, pprint=False, encoding="utf-8"):
+        if (self._xml is None and not pprint and encoding == "utf-8" and
+                self._raw.standalone):
+            return self._raw.raw
+        return super().toXml(pprint=pprint, encoding=encoding)
+
+
+def _lazyClass(Class):
+    return type("Lazy{}".format(Class.__name__), (_LazyStanza, Class), {})
+
+
 def makeStanza(elem):
-    if elem.tag == "presence":
-        return Presence(xml=elem)
+    '''Returns the Stanza for a received element or RawStanza, with its
+    ``header`` set.'''
+    if isinstance(elem, RawStanza):
+        Class = _LAZY_CLASSES.get(elem.tag, _LAZY_CLASSES[None])
+        stanza = Class.__new__(Class)
+        stanza._raw = elem
+        stanza._xml = None
+        stanza._header = elem.header
+        return stanza
+    elif elem.tag == "presence":
+        stanza = Presence(xml=elem)
     elif elem.tag == "message":
-        return Message(xml=elem)
+        stanza = Message(xml=elem)
     elif elem.tag == "iq":
-        return Iq(xml=elem)
+        stanza = Iq(xml=elem)
     elif elem.tag == "{%s}stream" % STREAM_NS_URI:
-        return StreamHeader(xml=elem)
+        stanza = StreamHeader(xml=elem)
     elif elem.tag == "{%s}features" % STREAM_NS_URI:
-        return StreamFeatures(xml=elem)
+        stanza = StreamFeatures(xml=elem)
     elif elem.tag == "{%s}error" % STREAM_NS_URI:
-        return StreamError(xml=elem)
+        stanza = StreamError(xml=elem)
     else:
-        return Stanza(xml=elem)
+        stanza = Stanza(xml=elem)
+
+    stanza._header = StanzaHeader.fromXml(elem)
+    return stanza
+
+
+_LAZY_CLASSES = {"presence": _lazyClass(Presence),
+                 "message": _lazyClass(Message),
+                 "iq": _lazyClass(Iq),
+                 None: _lazyClass(Stanza),
+                 }
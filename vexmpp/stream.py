@@ -1,4 +1,6 @@
 import os
+import time
+import weakref
 import asyncio
 import logging
 
@@ -9,16 +11,24 @@ from lxml import etree
 
 from . import stanzas
 from .stanzas import Iq
-from .parser import Parser
-from .utils import signalEvent
+from .jid import Jid, InvalidJidError
+from .parser import Parser, ParseError
+from .utils import signalEvent, headerMatcher, compiledXPath, xpathStanzaId
 from .utils import benchmark as timedWait
+from .metrics import ValueMetric
 
 from . import getLogger
 log = getLogger(__name__)
 
+# Chunks parsed and stanzas dispatched per ParserTask batch (batch mode only)
+parser_batch_chunks_met = ValueMetric("stream:parser_batch_chunks")
+parser_batch_stanzas_met = ValueMetric("stream:parser_batch_stanzas")
+# Bytes parsed per ParserTask executor offload
+parser_offload_bytes_met = ValueMetric("stream:parser_offload_bytes")
+# Bytes joined per transport write (cork mode and Stream.batch only)
+stream_corked_bytes_met = ValueMetric("stream:corked_bytes")
 
 if "VEX_TIMED_WAITS" in os.environ and int(os.environ["VEX_TIMED_WAITS"]):
-    from .metrics import ValueMetric
     stream_wait_met = ValueMetric("stream:wait_time", type_=float)
 else:
     stream_wait_met = None
@@ -27,22 +37,178 @@ _ENFORCE_TIMEOUTS = bool("VEX_ENFORCE_TIMEOUTS" in os.environ and
                          int(os.environ["VEX_ENFORCE_TIMEOUTS"]))
 
 
-class QueuedStanza:
-    def __init__(self, s):
-        self.task_set = set()
-        self.stanza = s
+def _approxSize(stanza):
+    """The wire size of lazily parsed stanzas, otherwise an estimate from
+    the tree's tags, attributes and text."""
+    size = getattr(stanza, "raw_size", None)
+    if size is None:
+        size = 0
+        for e in stanza.xml.iter():
+            size += 2 * len(e.tag) + 5 + len(e.text or "") + len(e.tail or "")
+            for name, value in e.attrib.items():
+                size += len(name) + len(value) + 4
+    return size
+
+
+class ReplayBuffer:
+    """The recently received stanzas, replayed to ``Stream.wait`` callers so
+    that a stanza received before the wait began is not missed.
+
+    The buffer holds at most ``max_count`` stanzas, ``max_bytes`` (approximate)
+    bytes and stanzas no older than ``max_age`` seconds, None values being
+    unlimited. Entries are indexed by stanza id. Each task's position in the
+    buffer is tracked, so it is not replayed stanzas it has already examined.
+    """
+    class Entry:
+        __slots__ = ("seq", "stanza", "size", "time")
+
+        def __init__(self, seq, stanza, size, time_):
+            self.seq = seq
+            self.stanza = stanza
+            self.size = size
+            self.time = time_
+
+    def __init__(self, max_count=100, max_bytes=1024 * 1024, max_age=30):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self._entries = deque()
+        self._by_id = {}
+        self._bytes = 0
+        self._seq = 0
+        # Task -> seq of the last entry it examined
+        self._seen = weakref.WeakKeyDictionary()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, stanza):
+        self._seq += 1
+        entry = self.Entry(self._seq, stanza,
+                           _approxSize(stanza) if self.max_bytes else 0,
+                           time.monotonic())
+        self._entries.append(entry)
+        self._bytes += entry.size
+        if stanza.id is not None:
+            self._by_id.setdefault(stanza.id, deque()).append(entry)
+
+        while (self._entries and
+                ((self.max_count is not None and
+                  len(self._entries) > self.max_count) or
+                 (self.max_bytes is not None and
+                  self._bytes > self.max_bytes))):
+            self._popOldest()
+        self._expire()
+        return entry
+
+    def entries(self, ids=None):
+        """The entries, oldest first. Only those with a stanza id in ``ids``
+        when given."""
+        self._expire()
+        if ids is None:
+            return list(self._entries)
+
+        entries = []
+        for id_ in ids:
+            entries.extend(self._by_id.get(id_, ()))
+        return sorted(entries, key=lambda e: e.seq)
+
+    def markSeen(self, task, entry=None):
+        """Records that ``task`` examined ``entry`` (all entries when None),
+        returning False if it already had."""
+        if task is None:
+            return True
+        seq = entry.seq if entry is not None else self._seq
+        if self._seen.get(task, 0) >= seq:
+            return False
+        self._seen[task] = seq
+        return True
+
+    def _expire(self):
+        if self.max_age is None:
+            return
+        oldest = time.monotonic() - self.max_age
+        while self._entries and self._entries[0].time < oldest:
+            self._popOldest()
+
+    def _popOldest(self):
+        entry = self._entries.popleft()
+        self._bytes -= entry.size
+        stanza_id = entry.stanza.id
+        if stanza_id is not None:
+            same_id = self._by_id[stanza_id]
+            same_id.popleft()
+            if not same_id:
+                del self._by_id[stanza_id]
+
+
+class _Resume:
+    """Awaitable that continues ``coro``, a coroutine run inline by
+    ``Stream._runHook`` that suspended yielding ``yielded``."""
+    def __init__(self, coro, yielded):
+        self._coro = coro
+        self._yielded = yielded
+
+    def __await__(self):
+        coro, value = self._coro, self._yielded
+        while True:
+            try:
+                sent = yield value
+            except BaseException as ex:
+                try:
+                    value = coro.throw(ex)
+                except StopIteration as stop:
+                    return stop.value
+            else:
+                try:
+                    value = coro.send(sent)
+                except StopIteration as stop:
+                    return stop.value
 
 
 class ParserTask(asyncio.Task):
-    def __init__(self, stream, loop=None):
+    """Feeds received bytes to a parser and dispatches the parsed stanzas.
+
+    ``parser_factory`` is a callable returning a parser object, the default
+    being :class:`vexmpp.parser.Parser`. Pass
+    :class:`vexmpp.parser.LxmlParser` to use the lxml backend, and use
+    ``functools.partial`` to set stanza limits, e.g.
+    ``partial(Parser, max_stanza_bytes=65536, max_depth=32)``.
+
+    When ``batch`` is True all queued chunks are drained and parsed together
+    and the resulting stanzas are dispatched as one batch, yielding to the
+    event loop once per batch rather than per matched stanza. See
+    ``parser_batch_chunks_met`` and ``parser_batch_stanzas_met``.
+
+    When ``offload_bytes`` is set, a stanza that grows beyond that many bytes
+    is finished in ``executor`` (the loop's default executor when None) so
+    that parsing it does not stall the event loop. Stanzas are still
+    dispatched on the loop, and in order. See ``parser_offload_bytes_met``.
+    Offloading does not apply to ``parseInline``.
+    """
+    def __init__(self, stream, parser_factory=None, batch=False,
+                 offload_bytes=None, executor=None, loop=None):
         super().__init__(self._run(), loop=loop)
-        self._parser = Parser()
+        self._parser = (parser_factory or Parser)()
         self._data_queue = asyncio.Queue()
         self._stream = stream
+        self._batch = batch
+        self._offload_bytes = offload_bytes
+        self._executor = executor
 
     def parse(self, bytes_):
         self._data_queue.put_nowait(bytes_)
 
+    def parseInline(self, bytes_):
+        """Parse ``bytes_`` now, bypassing the task, and return the complete
+        stanzas for the caller to dispatch."""
+        try:
+            return [self._makeStanza(e) for e in self._parser.parse(bytes_)]
+        except ParseError as ex:
+            self._parseError(ex)
+            return []
+
     def reset(self):
         self._parser.reset()
 
@@ -50,25 +216,88 @@ class ParserTask(asyncio.Task):
         while True:
             try:
                 data = await self._data_queue.get()
+                if self._batch:
+                    await self._runBatch(data)
+                    continue
 
-                elems = self._parser.parse(data)
+                elems = await self._parse(data)
                 for e in elems:
-                    stanza = stanzas.makeStanza(e)
-                    if log.getEffectiveLevel() <= logging.VERBOSE:
-                        log.verbose("[STANZA IN]:\n%s" %
-                                    stanza.toXml(pprint=True).decode("utf-8"))
+                    stanza = self._makeStanza(e)
                     await self._stream._handleStanza(stanza)
             except asyncio.CancelledError:
                 pass
+            except ParseError as ex:
+                self._parseError(ex)
             except Exception as ex:
                 log.exception(ex)
 
+    def _parseError(self, ex):
+        log.error("Parse error: {}".format(ex))
+        if ex.stream_error is not None:
+            self._stream.send(stanzas.StreamError(ex.stream_error))
+            self._stream.close()
+
+    def _drainQueue(self, data):
+        chunks = [data]
+        while not self._data_queue.empty():
+            chunks.append(self._data_queue.get_nowait())
+        return chunks
+
+    async def _parse(self, data):
+        if (self._offload_bytes is None or
+                self._parser.pending_bytes + len(data) < self._offload_bytes):
+            return self._parser.parse(data)
+
+        # A large stanza, parse it and anything queued behind it in the
+        # executor. The queue is only read by this task so the parser is
+        # never used concurrently.
+        data = b"".join(self._drainQueue(data))
+        parser_offload_bytes_met.update(len(data))
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._parser.parse,
+                                          data)
+
+    async def _runBatch(self, data):
+        chunks = self._drainQueue(data)
+        elems = await self._parse(b"".join(chunks)
+                                  if len(chunks) > 1 else data)
+
+        parser_batch_chunks_met.update(len(chunks))
+        parser_batch_stanzas_met.update(len(elems))
+        if elems:
+            await self._stream._handleStanzas([self._makeStanza(e)
+                                               for e in elems])
+
+    @staticmethod
+    def _makeStanza(elem):
+        stanza = stanzas.makeStanza(elem)
+        if log.getEffectiveLevel() <= logging.VERBOSE:
+            log.verbose("[STANZA IN]:\n%s" %
+                        stanza.toXml(pprint=True).decode("utf-8"))
+        return stanza
+
 
 class Stream(asyncio.Protocol):
-    """Base class for XMPP streams."""
+    """Base class for XMPP streams.
+
+    Mixin.onStanza hooks are run inline, in stanza and mixin order, and a
+    Task is only created for a hook that suspends (its first step runs in the
+    dispatching task). At most ``dispatch_budget`` seconds per event loop
+    iteration are spent running hooks, the rest are deferred, in order, to
+    the following iterations.
+
+    Received stanzas are kept in ``replay_buffer`` (a :class:`ReplayBuffer`)
+    for :meth:`wait`.
+
+    When ``cork`` is True the output of each event loop iteration is joined
+    into one transport write, see also :meth:`batch`.
+    """
 
     def __init__(self, creds, state_callbacks=None, mixins=None,
-                 default_timeout=None):
+                 default_timeout=None, parser_factory=None,
+                 batch_parsing=False, inline_parsing=False,
+                 parser_offload_bytes=None, dispatch_budget=0.01,
+                 replay_buffer=None, cork=False):
         self.creds = creds
         self._transport = None
         self._waiter_futures = []
@@ -84,13 +313,33 @@ class Stream(asyncio.Protocol):
                 else:
                     # Add the symbol to the stream's namespace
                     self.__dict__[name] = obj
+        self._indexMixins()
 
-        self._parser_task = ParserTask(self)
+        self._parser_task = ParserTask(self, parser_factory=parser_factory,
+                                       batch=batch_parsing,
+                                       offload_bytes=parser_offload_bytes)
+        # Parse in data_received rather than the parser task
+        self._inline_parsing = inline_parsing
         self.default_timeout = default_timeout
         # Stream errors
         self.error = None
 
-        self._stanza_queue = deque(maxlen=10)
+        self._replay = replay_buffer or ReplayBuffer()
+        # sendAndWait responses by id: (stanza name, to Jid, future)
+        self._pending_responses = {}
+
+        # (mixin, stanza) onStanza hooks to run, see _runHooks
+        self._hook_queue = deque()
+        self._dispatch_budget = dispatch_budget
+        self._hook_deadline = None
+        self._hooks_running = False
+        self._hooks_deferred = False
+
+        # Output held back for one write, see flush
+        self._cork = cork
+        self._corked = []
+        self._batch_depth = 0
+        self._flush_scheduled = False
 
     @property
     def connected(self):
@@ -115,6 +364,7 @@ class Stream(asyncio.Protocol):
     def close(self):
         if self.connected:
             self.send(b"</stream:stream>")
+            self.flush()
             self._transport.close()
         self._parser_task.cancel()
 
@@ -131,7 +381,13 @@ class Stream(asyncio.Protocol):
                 log.warn("Data send with disconnected transport")
                 return
 
-            self._transport.write(bytes_)
+            if self._batch_depth or self._cork:
+                if (not self._batch_depth and not self._flush_scheduled):
+                    asyncio.get_event_loop().call_soon(self.flush)
+                    self._flush_scheduled = True
+                self._corked.append(bytes_)
+            else:
+                self._transport.write(bytes_)
             log.debug("[BYTES OUT]: %s", bytes_)
 
         stanza = None
@@ -159,6 +415,30 @@ class Stream(asyncio.Protocol):
                 hook = partial(m.onSend, self, stanza)
                 asyncio.ensure_future(self._runMixin(hook))
 
+    def flush(self):
+        """Writes the output held back by cork mode or :meth:`batch`."""
+        self._flush_scheduled = False
+        if not self._corked or not self._transport:
+            return
+
+        data = b"".join(self._corked)
+        self._corked.clear()
+        self._transport.write(data)
+        stream_corked_bytes_met.update(len(data))
+
+    def batch(self):
+        """An asynchronous context manager holding back all output until the
+        (outermost) block exits, when it is written at once::
+
+            async with stream.batch():
+                for jid in roster:
+                    stream.send(Message(to=jid, body=body))
+
+        Output is also flushed before :meth:`wait` and :meth:`sendAndWait`
+        suspend.
+        """
+        return _StreamBatch(self)
+
     async def sendAndWaitIq(self, child_ns, to=None, child_name="query",
                             type="get", raise_on_error=False, timeout=None,
                             id_prefix=None):
@@ -169,12 +449,35 @@ class Stream(asyncio.Protocol):
         return resp
 
     async def sendAndWait(self, stanza, raise_on_error=False, timeout=None):
+        """Sends ``stanza`` and returns the response, the received stanza
+        with the same name and id and from the address ``stanza`` was sent
+        to. Responses are looked up by id, see ``_dispatchStanza``."""
         if not stanza.id:
             stanza.setId()
+        elif stanza.id in self._pending_responses:
+            raise ValueError("A response to id '{}' is already pending"
+                             .format(stanza.id))
 
-        xpath = "/%s[@id='%s']" % (stanza.name, stanza.id)
-        self.send(stanza)
-        resp = await self.wait([(xpath, None)], timeout=timeout)
+        if timeout is None and self.default_timeout:
+            timeout = self.default_timeout
+        if _ENFORCE_TIMEOUTS and not timeout:
+            raise RuntimeError("Timeout not set error")
+
+        stanza_id = stanza.id
+        fut = asyncio.Future()
+        self._pending_responses[stanza_id] = (stanza.name, stanza.to, fut)
+        try:
+            self.send(stanza)
+            self.flush()
+            resp = await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError as ex:
+            raise asyncio.TimeoutError(
+                    "Timeout ({}s) while waiting for response to id '{}'"
+                    .format(timeout, stanza_id)) from ex
+        finally:
+            pending = self._pending_responses.get(stanza_id)
+            if pending is not None and pending[2] is fut:
+                del self._pending_responses[stanza_id]
 
         if resp.error is not None and raise_on_error:
             raise resp.error
@@ -201,16 +504,18 @@ class Stream(asyncio.Protocol):
         if _ENFORCE_TIMEOUTS and not timeout:
             raise RuntimeError("Timeout not set error")
 
-        fut = _StreamWaitFuture(xpaths)
+        fut = _StreamWaitFuture(xpaths, self._replay)
 
-        # Run thru queue. Note, once a tasklet has seen a stanza it is skipped
-        # by _StreamWaitFuture.matchStanza
-        for queued_stanza in self._stanza_queue:
-            matched = fut.matchStanza(queued_stanza)
-            if matched:
-                return queued_stanza.stanza
+        # Replay received stanzas. Note, once a task has seen a stanza it is
+        # skipped by _StreamWaitFuture.matchStanza
+        for entry in self._replay.entries(ids=fut.ids):
+            if fut.matchStanza(entry):
+                return entry.stanza
+        self._replay.markSeen(fut.task)
 
         self._waiter_futures.append(fut)
+        # A batch must not hold back the stanza being waited upon
+        self.flush()
         try:
             with timedWait() as timer_stat:
                 match = await asyncio.wait_for(fut, timeout)
@@ -242,36 +547,188 @@ class Stream(asyncio.Protocol):
         self.connection_made(transport, tls=True)
 
     async def _handleStanza(self, stanza):
+        await self._handleStanzas([stanza])
+
+    async def _handleStanzas(self, stanza_list):
+        """Dispatch ``stanza_list`` in order. When more than one stanza is
+        given the event loop is yielded once, after the entire batch, instead
+        of after each stanza that matched a waiter."""
+        batched = len(stanza_list) > 1
+        matched = False
+
+        for stanza in stanza_list:
+            if isinstance(stanza, stanzas.StreamError):
+                self._streamErrorReceived(stanza)
+                break
+
+            if self._dispatchStanza(stanza):
+                matched = True
+                if not batched:
+                    # XXX: How useful is this since the replay buffer?
+                    # Yield the event loop, which is essential for a handle
+                    # and wait in quick succession.
+                    await asyncio.sleep(0)
+
+        if batched and matched:
+            await asyncio.sleep(0)
+
+    def _dispatchStanzas(self, stanza_list):
+        """Synchronous ``_handleStanzas``, used when parsing inline. Woken
+        waiters run once the caller returns to the event loop."""
+        for stanza in stanza_list:
+            if isinstance(stanza, stanzas.StreamError):
+                self._streamErrorReceived(stanza)
+                break
+            self._dispatchStanza(stanza)
+
+    def _dispatchStanza(self, stanza):
+        """Matches ``stanza`` against the waiters and runs (or queues) its
+        mixin hooks. Returns True if any waiter was matched."""
+        matched = False
+        if self._pending_responses and self._resolveResponse(stanza):
+            matched = True
+
+        entry = self._replay.append(stanza)
+
+        # Waiters have examined the earlier entries when they began waiting
+        for fut in self._waiter_futures:
+            if not fut.done() and fut.matchStanza(entry):
+                matched = True
+
+        for m in self._mixinsFor(stanza.header):
+            self._hook_queue.append((m, stanza))
+        if self._hook_queue:
+            self._runHooks()
+
+        return matched
+
+    def _runHooks(self):
+        """Runs queued hooks until the queue is empty or this loop
+        iteration's dispatch budget is spent."""
+        if self._hooks_running:
+            # A hook dispatched stanzas, they run after it in order
+            return
 
-        if isinstance(stanza, stanzas.StreamError):
-            signalEvent(self._callbacks, "streamError", self, stanza)
-            self._transport.close()
+        loop = asyncio.get_event_loop()
+        if self._hook_deadline is None and self._dispatch_budget is not None:
+            self._hook_deadline = loop.time() + self._dispatch_budget
+            loop.call_soon(self._resetHookDeadline)
+
+        self._hooks_running = True
+        try:
+            while self._hook_queue:
+                if (self._hook_deadline is not None and
+                        loop.time() >= self._hook_deadline):
+                    if not self._hooks_deferred:
+                        self._hooks_deferred = True
+                        loop.call_soon(self._runDeferredHooks)
+                    break
+                self._runHook(*self._hook_queue.popleft())
+        finally:
+            self._hooks_running = False
+
+    def _resetHookDeadline(self):
+        self._hook_deadline = None
+
+    def _runDeferredHooks(self):
+        self._hooks_deferred = False
+        self._runHooks()
+
+    def _runHook(self, mixin, stanza):
+        """Runs ``mixin.onStanza`` to its first suspension point, continuing
+        it in a Task if it suspended."""
+        try:
+            coro = mixin.onStanza(self, stanza)
+            if not asyncio.iscoroutine(coro):
+                return
+            yielded = coro.send(None)
+        except StopIteration:
+            return
+        except Exception:
+            log.exception("{} mixin error".format(type(mixin).__name__))
             return
 
-        for m in self._mixins:
-            hook = partial(m.onStanza, self, stanza)
-            asyncio.ensure_future(self._runMixin(hook))
+        asyncio.ensure_future(self._runMixin(partial(_Resume, coro, yielded)))
+
+    def _indexMixins(self):
+        """Indexes the mixins by the ``interests`` of their onStanza hooks
+        (see :func:`vexmpp.utils.xpathFilter`), keyed by (tag, type).
+        Mixins without interests are called for all stanzas."""
+        self._mixin_index = {}
+        self._unindexed_mixins = []
+        for i, m in enumerate(self._mixins):
+            interests = getattr(m.onStanza, "interests", None)
+            if interests is None:
+                self._unindexed_mixins.append(i)
+                continue
+            for tag, type_, child_ns in interests:
+                self._mixin_index.setdefault((tag, type_), []).append(
+                        (i, child_ns))
+
+    def _mixinsFor(self, header):
+        """The mixins, in order, whose onStanza hook may want a stanza with
+        ``header``. The hooks' own filters are still applied."""
+        if header is None:
+            return self._mixins
+
+        matches = set(self._unindexed_mixins)
+        for key in ((header.tag, header.type), (header.tag, None)):
+            for i, child_ns in self._mixin_index.get(key, ()):
+                if child_ns is None or child_ns == header.child_ns:
+                    matches.add(i)
+        return [self._mixins[i] for i in sorted(matches)]
+
+    def _resolveResponse(self, stanza):
+        """Completes the ``sendAndWait`` future ``stanza`` is a response to,
+        returning True if there was one."""
+        pending = self._pending_responses.get(stanza.id)
+        if pending is None:
+            return False
 
-        self._stanza_queue.append(QueuedStanza(stanza))
+        name, to, fut = pending
+        if (stanza.name != name or fut.done() or
+                (name == "iq" and stanza.type not in (Iq.TYPE_RESULT,
+                                                      Iq.TYPE_ERROR)) or
+                not self._isResponseFrom(to, stanza.get("from"))):
+            return False
 
-        if self._waiter_futures:
-            for queued_stanza in self._stanza_queue:
-                for fut in [f for f in self._waiter_futures if not f.done()]:
-                    matched = fut.matchStanza(queued_stanza)
-                    if matched:
-                        # XXX: How useful is this since _stanza_queue?
-                        # Yield the event loop, which is essential for a handle
-                        # and wait in quick succession.
-                        await asyncio.sleep(0)
+        del self._pending_responses[stanza.id]
+        fut.set_result(stanza)
+        return True
+
+    def _isResponseFrom(self, to, frm):
+        """True if ``frm`` may send the response to a stanza sent ``to``."""
+        if to is None:
+            # Sent to our own account, answered by it or our server.
+            if frm is None:
+                return True
+            expected = [self.jid, self.jid.bare_jid, Jid(self.jid.host)]
+        else:
+            expected = [to]
+
+        try:
+            return Jid(frm) in expected
+        except InvalidJidError:
+            return False
+
+    def _streamErrorReceived(self, stream_error):
+        signalEvent(self._callbacks, "streamError", self, stream_error)
+        self._transport.close()
 
     # asyncio.Protocol implementation
     def data_received(self, data):
         log.debug('[BYTES IN]: {!r}'.format(data.decode()))
-        self._parser_task.parse(data)
+        if self._inline_parsing:
+            stanza_list = self._parser_task.parseInline(data)
+            if stanza_list:
+                self._dispatchStanzas(stanza_list)
+        else:
+            self._parser_task.parse(data)
 
     # asyncio.Protocol implementation
     def connection_lost(self, reason):
         self._transport = None
+        self._corked.clear()
         self._tls_active = False
         log.debug('The server closed the connection: %s' % str(reason))
         signalEvent(self._callbacks, "disconnected", self, reason)
@@ -293,6 +750,21 @@ class Stream(asyncio.Protocol):
             log.exception("{} mixin error".format(functor.__class__.__name__))
 
 
+class _StreamBatch:
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def __aenter__(self):
+        self._stream._batch_depth += 1
+        return self._stream
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._stream._batch_depth -= 1
+        if not self._stream._batch_depth:
+            self._stream.flush()
+        return False
+
+
 class Mixin(object):
     def __init__(self, export_tuples=None):
         """
@@ -310,9 +782,12 @@ class Mixin(object):
         """Called for each incoming Stanza.
 
         See :func:`vexmpp.utils.xpathFilter` for a decorator that can filter
-        only the stanzas the implementation is interested in.
+        only the stanzas the implementation is interested in, the stream only
+        calls the hook for stanzas the filter may match.
         """
         pass
+    # Not overridden, no stanzas wanted
+    onStanza.interests = []
 
     async def onSend(self, stream, stanza):
         """Called for each outgoing stanza."""
@@ -330,25 +805,44 @@ class StreamCallbacks:
         pass
 
 
+# asyncio.Task.current_task was removed in Python 3.9
+_currentTask = getattr(asyncio, "current_task", None) or \
+                   asyncio.Task.current_task
+
+
 class _StreamWaitFuture(asyncio.Future):
-    def __init__(self, xpaths, *args, loop=None):
+    def __init__(self, xpaths, replay, *args, loop=None):
         super().__init__(*args, loop=loop)
         self._xpaths = xpaths
-        self._task = asyncio.Task.current_task()
-
-    def matchStanza(self, queued_stanza):
-        log.debug(f"MatchStanza: {queued_stanza.stanza.toXml()} xpaths: "
-                  "{0} - @{1}".format(self._xpaths, id(self._task)))
-        if self._task in queued_stanza.task_set:
+        self._replay = replay
+        self._matchers = [headerMatcher(xp, nsmap) for xp, nsmap in xpaths]
+        self._compiled = [compiledXPath(xp, nsmap) for xp, nsmap in xpaths]
+        self.task = _currentTask()
+
+        # The stanza ids to replay when every xpath requires one
+        ids = [xpathStanzaId(xp, nsmap) for xp, nsmap in xpaths]
+        self.ids = None if None in ids else set(ids)
+
+    def matchStanza(self, entry):
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug(f"MatchStanza: {entry.stanza.toXml()} xpaths: "
+                      "{0} - @{1}".format(self._xpaths, id(self.task)))
+        if not self._replay.markSeen(self.task, entry):
             # seen this...
             return False
-        queued_stanza.task_set.add(self._task)
 
-        stanza = queued_stanza.stanza
-        for xp, nsmap in self._xpaths:
-            log.debug("MatchStanza: Testing xpath {} against stanza {}"
-                      .format((xp, nsmap), stanza.toXml()))
-            if stanza.xml.xpath(xp, namespaces=nsmap):
+        stanza = entry.stanza
+        header = stanza.header
+        for (xp, nsmap), matcher, xpath in zip(self._xpaths, self._matchers,
+                                               self._compiled):
+            if header is not None and matcher is not None and \
+                    not matcher(header):
+                continue
+            if debug:
+                log.debug("MatchStanza: Testing xpath {} against stanza {}"
+                          .format((xp, nsmap), stanza.toXml()))
+            if xpath(stanza.xml):
                 log.debug("MatchStanza: matched")
                 self.set_result(stanza)
                 return True
@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
+import re
 import time
 import random
 import asyncio
 import functools
 from operator import attrgetter
+from collections import namedtuple
 from ipaddress import ip_address
 
 import aiodns
+from lxml import etree
 
 from nicfit import getLogger
+from .metrics import CounterMetric
 log = getLogger(__name__)
 
+# Compiled XPath cache lookups, see compiledXPath
+xpath_cache_hits_met = CounterMetric("xpath_cache:hits")
+xpath_cache_misses_met = CounterMetric("xpath_cache:misses")
+
 
 class benchmark(object):
     '''A context manager for taking timing blocks of code.'''
@@ -117,9 +125,127 @@ def formatTime(seconds, total=None, short=False):
         return u'  ~inf'
 
 
-def xpathFilter(xpaths):
+# (xpath, nsmap items) mapped to etree.XPath objects. Bounded, once full new
+# expressions are compiled but not cached.
+_XPATH_CACHE = {}
+_XPATH_CACHE_MAX = 1024
+
+
+def compiledXPath(xpath, nsmap=None):
+    '''Returns a compiled ``etree.XPath`` for ``xpath`` and ``nsmap`` from a
+    process-wide cache. Call it with the element to evaluate, as in
+    ``compiledXPath("/iq/ns:query", {"ns": NS_URI})(stanza.xml)``.'''
+    key = (xpath, frozenset(nsmap.items()) if nsmap else None)
+    compiled = _XPATH_CACHE.get(key)
+    if compiled is None:
+        xpath_cache_misses_met.inc()
+        compiled = etree.XPath(xpath, namespaces=nsmap)
+        if len(_XPATH_CACHE) < _XPATH_CACHE_MAX:
+            _XPATH_CACHE[key] = compiled
+    else:
+        xpath_cache_hits_met.inc()
+    return compiled
+
+
+_XPATH_HEADER_RE = re.compile(r"^/(?:(\w+):)?(\w+)"
+                              r"((?:\[@\w+=(?:'[^']*'|\"[^\"]*\")\])*)"
+                              r"(?:/(\w+):[\w-]+)?(?:[/\[].*)?$")
+_XPATH_ATTR_RE = re.compile(r"\[@(\w+)=(?:'([^']*)'|\"([^\"]*)\")\]")
+_HEADER_ATTRS = {"type": "type", "id": "id", "from": "frm", "to": "to"}
+
+
+StanzaInterest = namedtuple("StanzaInterest", "tag, type, child_ns")
+StanzaInterest.__doc__ = '''The stanzas a handler wants, by header tag, type and
+child namespace (see :class:`vexmpp.stanzas.StanzaHeader`). None values
+match anything.'''
+
+
+def _analyzeXPath(xpath, nsmap):
+    '''Returns the (tag, [(header field, value)], child_ns) a stanza must have
+    to match ``xpath``, or None if the XPath is not simple enough.'''
+    match = _XPATH_HEADER_RE.match(xpath)
+    if match is None:
+        return None
+    prefix, name, attrs, child_prefix = match.groups()
+    nsmap = nsmap or {}
+
+    if prefix:
+        if prefix not in nsmap:
+            return None
+        tag = "{%s}%s" % (nsmap[prefix], name)
+    else:
+        tag = name
+
+    checks = []
+    for attr, value1, value2 in _XPATH_ATTR_RE.findall(attrs):
+        if attr in _HEADER_ATTRS:
+            checks.append((_HEADER_ATTRS[attr], value1 or value2))
+    attr_values = dict(checks)
+
+    # An iq get or set has exactly one payload element, so its namespace
+    # is that of the first child.
+    child_ns = None
+    if (tag == "iq" and child_prefix and child_prefix in nsmap and
+            attr_values.get("type") in ("get", "set")):
+        child_ns = nsmap[child_prefix]
+
+    return tag, checks, child_ns
+
+
+def stanzaInterest(xpath, nsmap=None):
+    '''Returns the :class:`StanzaInterest` of ``xpath``, or None if it is not
+    simple enough to analyze.'''
+    analysis = _analyzeXPath(xpath, nsmap)
+    if analysis is None:
+        return None
+    tag, checks, child_ns = analysis
+    return StanzaInterest(tag, dict(checks).get("type"), child_ns)
+
+
+def xpathStanzaId(xpath, nsmap=None):
+    '''Returns the stanza id ``xpath`` requires, e.g. "a1" for
+    "/iq[@id='a1']", or None.'''
+    analysis = _analyzeXPath(xpath, nsmap)
+    if analysis is None:
+        return None
+    return dict(analysis[1]).get("id")
+
+
+def headerMatcher(xpath, nsmap=None):
+    '''Returns a function that tests a :class:`vexmpp.stanzas.StanzaHeader`
+    against the stanza tag, routing attributes and payload namespace that
+    ``xpath`` requires. When it returns False the XPath cannot match the
+    stanza, True means the XPath must still be evaluated.
+
+    None is returned for XPaths that are not simple enough to analyze.
     '''
-    FIXME
+    analysis = _analyzeXPath(xpath, nsmap)
+    if analysis is None:
+        return None
+    tag, checks, child_ns = analysis
+
+    def _matcher(header):
+        if header.tag != tag:
+            return False
+        for field, value in checks:
+            if getattr(header, field) != value:
+                return False
+        if child_ns is not None and header.child_ns != child_ns:
+            return False
+        return True
+
+    return _matcher
+
+
+def xpathFilter(xpaths):
+    '''Decorator for Mixin.onStanza (and similar) coroutines, which are only
+    invoked when the stanza matches one of ``xpaths``. ``xpaths`` is an XPath
+    string, an (xpath, nsmap) tuple, or a list of either.
+
+    The stanza header is checked before the XPaths are evaluated. The
+    decorated function's ``interests`` attribute is the list of
+    :class:`StanzaInterest` derived from ``xpaths``, or None when any of them
+    is too complex to analyze; Stream uses it to index Mixin.onStanza hooks.
     '''
     if isinstance(xpaths, str):
         # "xpath" -> [("xpath", None)]
@@ -128,6 +254,13 @@ def xpathFilter(xpaths):
         # ("xpath", nsmap) -> [("xpath", nsmap)]
         xpaths = [xpaths]
 
+    xpaths = [(xp, None) if isinstance(xp, str) else xp for xp in xpaths]
+    matchers = [headerMatcher(xp, ns_map) for xp, ns_map in xpaths]
+    compiled_xpaths = [compiledXPath(xp, ns_map) for xp, ns_map in xpaths]
+    interests = [stanzaInterest(xp, ns_map) for xp, ns_map in xpaths]
+    if None in interests:
+        interests = None
+
     def wrapper(func):
 
         @functools.wraps(func)
@@ -141,13 +274,15 @@ def xpathFilter(xpaths):
                     break
             if stanza is None:
                 raise TypeError("No arguments of type Stanza found")
-            for xp in xpaths:
-                if isinstance(xp, str):
-                    xp, ns_map = xp, None
-                else:
-                    xp, ns_map = xp
-
-                if stanza.xml.xpath(xp, namespaces=ns_map):
+            # Received stanzas have a header that rules out most XPaths
+            # without searching (or building) the element tree.
+            header = stanza.header
+            for matcher, xpath in zip(matchers, compiled_xpaths):
+                if (header is not None and matcher is not None and
+                        not matcher(header)):
+                    continue
+
+                if xpath(stanza.xml):
                     # Matching xpath, invoke the function
                     return func(*args, **kwargs)
 
@@ -156,6 +291,7 @@ def xpathFilter(xpaths):
                 return None
             return _noOpCoro(*args, **kwargs)
 
+        wrapped_func.interests = interests
         return wrapped_func
 
     return wrapper